@@ -0,0 +1,3 @@
+from .core import FastMapABC, FastMapEuclidean
+
+__all__ = ["FastMapABC", "FastMapEuclidean"]
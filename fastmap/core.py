@@ -0,0 +1,595 @@
+"""
+Core implementation of the FastMap algorithm (Faloutsos & Lin, 1995)
+over an array-backend-agnostic interface. Computations run via NumPy
+on CPU or, optionally, via CuPy on GPU.
+
+Subclasses implement the object distance by overriding
+_distance_func(), which must broadcast over leading batch dimensions
+and reduce over the trailing feature dimensions.
+"""
+
+import numpy as np
+import scipy.spatial.distance
+
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+
+try:
+    import numba as nb
+except ImportError:
+    nb = None
+
+DTYPE_INT  = np.int32
+DTYPE_REAL = np.float64
+EPSILON    = 1e-9
+BATCH_SIZE = 1024
+L2_BYTES   = 2 ** 21
+
+
+class FastMapABC(object):
+
+    def __init__(self, n_dim, batch_size=BATCH_SIZE, cupy=False,
+                 dtype_x=None, numba=False):
+        """
+        Arguments
+        n_dim - Dimensionality of the Euclidean embedding.
+        batch_size - Number of objects per batch in distance
+            computations.
+        cupy - If True, run array computations on GPU via CuPy.
+        dtype_x - Optional storage dtype for X (e.g. np.float16).
+            Halves the bytes streamed per distance pass; feature
+            reductions accumulate in float32 and the images W stay
+            float64. Features should be roughly unit scale to avoid
+            low-precision overflow.
+        numba - If True, compute corrected distances on the NumPy
+            backend with a fused, thread-parallel guvectorize kernel
+            where the metric supports it.
+        """
+        if cupy is True and cp is None:
+            raise (
+                ImportError(
+                    "cupy backend requested but cupy is not installed."
+                )
+            )
+        if numba is True and nb is None:
+            raise (
+                ImportError(
+                    "numba acceleration requested but numba is not"
+                    " installed."
+                )
+            )
+        self._n_dim = n_dim
+        self._batch_size = batch_size
+        self._xp = cp if cupy is True else np
+        self._ihyprpln = 0
+        self._pivot_ids = None
+        self._W_piv = None
+        self._X_piv = None
+        self._X_dev = None
+        self._X_dev_f64 = None
+        self._W_dev = None
+        self._rng = np.random.default_rng()
+        self._dtype_x = dtype_x
+        self._numba = numba
+
+
+    @property
+    def batch_size(self):
+        return (self._batch_size)
+
+    @property
+    def n_dim(self):
+        return (self._n_dim)
+
+    @property
+    def pivot_ids(self):
+        if self._pivot_ids is None:
+            self._pivot_ids = np.empty((self.n_dim, 2), dtype=DTYPE_INT)
+        return (self._pivot_ids)
+
+    @property
+    def W_piv(self):
+        # Pivot-major (2, n_dim, n_dim) layout: the images of the "a"
+        # and "b" pivots each form a contiguous slab.
+        if self._W_piv is None:
+            self._W_piv = np.empty(
+                (2, self.n_dim, self.n_dim), dtype=DTYPE_REAL
+            )
+        return (self._W_piv)
+
+    @property
+    def X_piv(self):
+        # Pivot-major (2, n_dim, *feature) layout, as for W_piv.
+        if self._X_piv is None:
+            self._X_piv = np.empty(
+                (2, self.n_dim, *self.X.shape[1:]), dtype=self.X.dtype
+            )
+        return (self._X_piv)
+
+    @property
+    def xp(self):
+        return (self._xp)
+
+
+    def _choose_pivots(self):
+        """
+        Return a pair of indices corresponding to a heuristically
+        chosen pair of distal objects.
+        """
+        n_obj = self.X.shape[0]
+        forbidden = self.pivot_ids[:self._ihyprpln].flatten()
+        allowed = np.ones(n_obj, dtype=bool)
+        allowed[forbidden] = False
+
+        j_obj = self._rng.choice(np.flatnonzero(allowed))
+        furthest = self.furthest(j_obj)
+        i_obj = furthest[np.argmax(allowed[furthest])]
+        furthest = self.furthest(i_obj)
+        j_obj = furthest[np.argmax(allowed[furthest])]
+
+        return (i_obj, j_obj)
+
+
+    def _distance_func(self, X_1, X_2):
+        """
+        Return the distance between objects X_1 and X_2, broadcasting
+        over leading batch dimensions and reducing over trailing
+        feature dimensions.
+        """
+        raise (NotImplementedError)
+
+
+    def _sqdistance_block(self, X_1, X_2):
+        """
+        Return the (len(X_1), len(X_2)) block of squared distances
+        between objects X_1 and X_2. The default squares
+        _distance_func over broadcast batch axes; subclasses may
+        override with a block-level kernel.
+        """
+        d = self._distance_func(X_1[:, None], X_2[None, :])
+
+        return (self.xp.square(d))
+
+
+    def distance_matrix(self, i_objs, j_obj, X_1=None, X_2=None,
+                        W_1=None, W_2=None):
+        """
+        Return the distances between objects i_objs and object j_obj
+        projected onto hyperplane self._ihyprpln.
+
+        The hyperplane corrections telescope algebraically, so they
+        are applied in a single pass: the squared image deltas are
+        summed over hyperplanes 0..self._ihyprpln and subtracted from
+        the squared base distance once, with a single clip and sqrt.
+        """
+        xp = self.xp
+        if X_1 is None:
+            X_1 = self.X if self._X_dev is None else self._X_dev
+        if X_2 is None:
+            X_2 = self.X if self._X_dev is None else self._X_dev
+        if W_1 is None:
+            W_1 = self.W if self._W_dev is None else self._W_dev
+        if W_2 is None:
+            W_2 = self.W if self._W_dev is None else self._W_dev
+        n_obj = len(i_objs)
+        dist = xp.empty(n_obj, dtype=DTYPE_REAL)
+        X_j = X_2[[j_obj]]
+        W_j = W_2[j_obj]
+
+        for i in range(0, n_obj, self.batch_size):
+            idxs = i_objs[i: i + self.batch_size]
+            X_i = X_1[idxs]
+            W_i = W_1[idxs]
+            d = self._sqdistance_block(X_i, X_j)[:, 0]
+            dW = W_i - W_j
+            xp.square(dW, out=dW)
+            dW_sum = xp.sum(dW[:, :self._ihyprpln], axis=1)
+            d -= dW_sum
+            xp.maximum(d, 0, out=d)
+            xp.sqrt(d, out=d)
+            dist[i: i + self.batch_size] = d
+
+        return (dist)
+
+
+    def fit(self, X):
+        """
+        Fit the FastMap embedding to training objects X and return
+        their images W.
+        """
+        if self._dtype_x is not None:
+            X = np.asarray(X).astype(self._dtype_x)
+        self.X = X
+        n_obj = X.shape[0]
+        self.W = np.full((n_obj, self.n_dim), np.nan, dtype=DTYPE_REAL)
+        if self.xp is not np:
+            # Upload X and W once instead of once per batch per pass.
+            self._X_dev = self.xp.asarray(X)
+            self._X_dev_f64 = None
+            self._W_dev = self.xp.asarray(self.W)
+        # During training, write only the working copy of W — on the
+        # CuPy backend that keeps every per-hyperplane column write
+        # on device; the host copy syncs once after the loop.
+        W_fit = self.W if self._W_dev is None else self._W_dev
+
+        for self._ihyprpln in range(self.n_dim):
+            i_piv, j_piv = self._choose_pivots()
+            self.pivot_ids[self._ihyprpln] = i_piv, j_piv
+            self.X_piv[0, self._ihyprpln] = X[i_piv]
+            self.X_piv[1, self._ihyprpln] = X[j_piv]
+            d_ij = self.distance_matrix([i_piv], j_piv)[0]
+            if d_ij == 0:
+                W_fit[:, self._ihyprpln] = 0
+                continue
+            W_fit[:, self._ihyprpln] = self._project(
+                i_piv, j_piv, d_ij
+            )
+
+        if self._W_dev is not None:
+            self.W = self.get_array(self._W_dev)
+
+        for i in range(self.n_dim):
+            self.W_piv[:, i] = self.W[self.pivot_ids[i]]
+
+        return (self.W)
+
+
+    def _project(self, i_piv, j_piv, d_ij):
+        """
+        Return the images of all objects projected onto the line
+        through pivot objects i_piv and j_piv on hyperplane
+        self._ihyprpln.
+
+        Objects are processed in tiles sized so that a block of X and
+        its image rows fit in L2: each tile is loaded once and serves
+        both pivot legs, the hyperplane correction and the projection
+        arithmetic.
+        """
+        xp = self.xp
+        X = self.X if self._X_dev is None else self._X_dev
+        W = self.W if self._W_dev is None else self._W_dev
+        n_obj = X.shape[0]
+        X_pair = xp.stack((X[i_piv], X[j_piv]))
+        W_pair = xp.stack((W[i_piv], W[j_piv]))
+        d = xp.empty(n_obj, dtype=DTYPE_REAL)
+        feature_bytes = X.itemsize * int(
+            np.prod(X.shape[1:], dtype=np.int64)
+        )
+        block = max(
+            1,
+            L2_BYTES // (feature_bytes + self.n_dim * W.itemsize)
+        )
+        for i in range(0, n_obj, block):
+            self._fit_project_block(
+                X[i: i + block], W[i: i + block],
+                X_pair, W_pair, d_ij,
+                d[i: i + block]
+            )
+
+        return (d)
+
+
+    def _fit_project_block(self, X_blk, W_blk, X_pair, W_pair, d_ij,
+                           out):
+        """
+        Project one block of objects onto the line through the pivot
+        pair, writing the new coordinates into out. Both pivot legs
+        and the correction are computed on a single load of the
+        block.
+        """
+        xp = self.xp
+        d2 = self._sqdistance_block(X_blk, X_pair)
+        dW = W_blk[:, None, :] - W_pair[None, :, :]
+        xp.square(dW, out=dW)
+        d2 -= xp.sum(dW[:, :, :self._ihyprpln], axis=2)
+        xp.maximum(d2, 0, out=d2)
+        out[...] = d2[:, 0]
+        out += d_ij ** 2
+        out -= d2[:, 1]
+        out /= (2 * d_ij + EPSILON)
+
+        return (out)
+
+
+    def furthest(self, j_obj):
+        """
+        Return the indices of all objects sorted by decreasing
+        distance from object j_obj on hyperplane self._ihyprpln.
+        """
+        n_obj = self.X.shape[0]
+        dist = self.distance_matrix(np.arange(n_obj), j_obj)
+
+        return (self.get_array(self.xp.argsort(dist))[::-1])
+
+
+    def get_array(self, array):
+        """
+        Return array as a host-side numpy array.
+        """
+        if self.xp is np:
+            return (array)
+
+        return (self.xp.asnumpy(array))
+
+
+    def transform(self, X):
+        """
+        Return the images W of objects X using the stored pivot
+        objects.
+        """
+        xp = self.xp
+        if self._dtype_x is not None:
+            X = np.asarray(X).astype(self._dtype_x)
+        n_obj = X.shape[0]
+        W = np.full((n_obj, self.n_dim), np.nan, dtype=DTYPE_REAL)
+        X_piv = xp.array(self.X_piv)
+        W_piv = xp.array(self.W_piv)
+
+        # Base (hyperplane-0) distances between each pivot pair.
+        d_ij0 = xp.empty(self.n_dim, dtype=DTYPE_REAL)
+        for i in range(self.n_dim):
+            d_ij0[i] = self._distance_func(X_piv[0, i], X_piv[1, i])
+
+        # Corrected distances between each pivot pair, for every
+        # hyperplane at once: the correction for hyperplane i is the
+        # prefix sum over the first i squared image deltas, so a
+        # single cumsum covers all hyperplanes.
+        idx = xp.arange(1, self.n_dim)
+        dW_ij_cum = xp.cumsum(xp.square(W_piv[0] - W_piv[1]), axis=1)
+        corr_ij = xp.zeros(self.n_dim, dtype=DTYPE_REAL)
+        corr_ij[1:] = dW_ij_cum[idx, idx - 1]
+        d_ij_all = xp.sqrt(xp.maximum(xp.square(d_ij0) - corr_ij, 0))
+
+        # Prefix sums of the squared pivot images, used in the
+        # expansion sum((w - p)**2) = sum(w**2) - 2*w.p + sum(p**2).
+        W_piv_cum = xp.cumsum(xp.square(W_piv), axis=2)
+        corr_piv = xp.zeros((2, self.n_dim), dtype=DTYPE_REAL)
+        corr_piv[:, 1:] = W_piv_cum[:, idx, idx - 1]
+
+        # Hoist the per-pivot slabs so the hyperplane loop below does
+        # plain row/column indexing instead of re-slicing compound
+        # indices every iteration.
+        W_piv_a, W_piv_b = W_piv[0], W_piv[1]
+        corr_piv_a, corr_piv_b = corr_piv[0], corr_piv[1]
+
+        for ibatch in range(0, n_obj, self.batch_size):
+            X_batch = xp.array(X[ibatch: ibatch + self.batch_size])
+            n_batch = X_batch.shape[0]
+            W_batch = xp.zeros((n_batch, self.n_dim), dtype=DTYPE_REAL)
+
+            # Squared base distances between batch objects and all
+            # pivots, both pivots of each pair per block call.
+            d2_k0 = xp.empty((n_batch, self.n_dim, 2), dtype=DTYPE_REAL)
+            for i in range(self.n_dim):
+                d2_k0[:, i, :] = self._sqdistance_block(
+                    X_batch, X_piv[:, i]
+                )
+            d2_ik0, d2_jk0 = d2_k0[..., 0], d2_k0[..., 1]
+
+            # Running prefix sum of the squared batch images; the
+            # cross terms against the pivot images are single BLAS
+            # products per hyperplane.
+            W_cum = xp.zeros(n_batch, dtype=DTYPE_REAL)
+            for self._ihyprpln in range(self.n_dim):
+                i = self._ihyprpln
+                if i > 0:
+                    W_cum += xp.square(W_batch[:, i - 1])
+                    cross_ik = W_batch[:, :i] @ W_piv_a[i, :i]
+                    cross_ik *= 2
+                    cross_jk = W_batch[:, :i] @ W_piv_b[i, :i]
+                    cross_jk *= 2
+                else:
+                    cross_ik = cross_jk = 0.0
+                d_ij = d_ij_all[i]
+                d_ik = d2_ik0[:, i].copy()
+                d_ik -= W_cum
+                d_ik += cross_ik
+                d_ik -= corr_piv_a[i]
+                xp.maximum(d_ik, 0, out=d_ik)
+                d_jk = d2_jk0[:, i].copy()
+                d_jk -= W_cum
+                d_jk += cross_jk
+                d_jk -= corr_piv_b[i]
+                xp.maximum(d_jk, 0, out=d_jk)
+                d_ik += d_ij ** 2
+                d_ik -= d_jk
+                d_ik /= (2 * d_ij + EPSILON)
+                W_batch[:, i] = d_ik
+
+            W[ibatch: ibatch + self.batch_size] = self.get_array(W_batch)
+
+        return (W)
+
+
+class FastMapEuclidean(FastMapABC):
+    """
+    FastMap embedding of objects under the Euclidean metric.
+    """
+
+    def _distance_func(self, X_1, X_2):
+        xp = self.xp
+        n_axes = self.X.ndim - 1
+        axes = tuple(range(-n_axes, 0))
+        diff = X_1 - X_2
+        # Low-precision storage still accumulates in float32.
+        acc = DTYPE_REAL if diff.dtype == DTYPE_REAL else np.float32
+
+        return (xp.sqrt(xp.sum(xp.square(diff), axis=axes, dtype=acc)))
+
+
+    def _sqdistance_block(self, X_1, X_2):
+        xp = self.xp
+        X_1 = X_1.reshape(len(X_1), -1)
+        X_2 = X_2.reshape(len(X_2), -1)
+        if xp is np and X_1.dtype == DTYPE_REAL:
+            # cdist dispatches to a cache-tiled gemm-based kernel.
+            return (
+                scipy.spatial.distance.cdist(X_1, X_2, "sqeuclidean")
+            )
+        # CuPy and low-precision storage: explicit
+        # |x|^2 + |y|^2 - 2*X_1@X_2.T decomposition with float32
+        # accumulation.
+        acc = DTYPE_REAL if X_1.dtype == DTYPE_REAL else np.float32
+        X_1 = X_1.astype(acc, copy=False)
+        X_2 = X_2.astype(acc, copy=False)
+        s_1 = xp.square(X_1).sum(axis=1)
+        s_2 = xp.square(X_2).sum(axis=1)
+        d2 = X_1 @ X_2.T
+        d2 *= -2
+        d2 += s_1[:, None]
+        d2 += s_2[None, :]
+        xp.maximum(d2, 0, out=d2)
+
+        return (d2)
+
+
+    def distance_matrix(self, i_objs, j_obj, X_1=None, X_2=None,
+                        W_1=None, W_2=None):
+        """
+        Return the distances between objects i_objs and object j_obj
+        projected onto hyperplane self._ihyprpln. With numba=True on
+        the NumPy backend, the base distance and the hyperplane
+        correction run as one fused, cache-resident sweep per object
+        with no intermediate arrays.
+        """
+        if self._numba is not True or self.xp is not np:
+            return (
+                super().distance_matrix(
+                    i_objs, j_obj, X_1=X_1, X_2=X_2, W_1=W_1, W_2=W_2
+                )
+            )
+        if X_1 is None:
+            X_1 = self.X
+        if X_2 is None:
+            X_2 = self.X
+        if W_1 is None:
+            W_1 = self.W
+        if W_2 is None:
+            W_2 = self.W
+        X_i = X_1[i_objs].reshape(len(i_objs), -1)
+        X_j = np.asarray(X_2[j_obj]).reshape(-1)
+        if X_i.dtype not in (np.float32, np.float64):
+            X_i = X_i.astype(np.float32)
+            X_j = X_j.astype(np.float32)
+
+        return (
+            _correct_dist(
+                X_i, X_j, W_1[i_objs], W_2[j_obj],
+                np.int64(self._ihyprpln)
+            )
+        )
+
+
+    def _project(self, i_piv, j_piv, d_ij):
+        if self.xp is not cp:
+            return (super()._project(i_piv, j_piv, d_ij))
+
+        if self._X_dev_f64 is None:
+            # Cast once per fit, not once per hyperplane — with a
+            # low-precision dtype_x this is a full copy of X.
+            X = self.X if self._X_dev is None else self._X_dev
+            self._X_dev_f64 = cp.ascontiguousarray(
+                cp.asarray(X, dtype=DTYPE_REAL).reshape(X.shape[0], -1)
+            )
+        X = self._X_dev_f64
+        W = self.W if self._W_dev is None else self._W_dev
+        W = cp.ascontiguousarray(cp.asarray(W, dtype=DTYPE_REAL))
+        n_obj, n_feat = X.shape
+        d = cp.empty(n_obj, dtype=DTYPE_REAL)
+        n_threads = 256
+        n_blocks = (n_obj + n_threads - 1) // n_threads
+        _project_kernel()(
+            (n_blocks,), (n_threads,),
+            (
+                X, X[i_piv], X[j_piv], W, W[i_piv], W[j_piv],
+                np.float64(d_ij), np.float64(EPSILON),
+                np.int32(n_obj), np.int64(n_feat),
+                np.int32(self._ihyprpln), np.int32(self.n_dim),
+                d
+            )
+        )
+
+        return (d)
+
+
+if nb is not None:
+
+    @nb.guvectorize(
+        [
+            "void(float64[:], float64[:], float64[:], float64[:],"
+            " int64, float64[:])",
+            "void(float32[:], float32[:], float64[:], float64[:],"
+            " int64, float64[:])",
+        ],
+        "(d),(d),(k),(k),()->()",
+        nopython=True,
+        target="parallel",
+        cache=True
+    )
+    def _correct_dist(x_i, x_j, w_i, w_j, n_hyprpln, out):
+        """
+        Fused Euclidean distance with hyperplane correction: one
+        streaming pass per object, no intermediate arrays.
+        """
+        d2 = 0.0
+        for m in range(x_i.shape[0]):
+            diff = x_i[m] - x_j[m]
+            d2 += diff * diff
+        for k in range(n_hyprpln):
+            diff = w_i[k] - w_j[k]
+            d2 -= diff * diff
+            if d2 < 0:
+                d2 = 0.0
+                break
+        out[0] = np.sqrt(d2)
+
+
+_PROJECT_KERNEL_SRC = r"""
+extern "C" __global__ void fastmap_project(
+    const double* X, const double* X_pi, const double* X_pj,
+    const double* W, const double* W_pi, const double* W_pj,
+    const double d_ij, const double eps,
+    const int n_obj, const long long n_feat,
+    const int n_hyprpln, const int n_dim,
+    double* out
+)
+{
+    int i = blockDim.x * blockIdx.x + threadIdx.x;
+    if (i >= n_obj) return;
+    double d_ik2 = 0.0, d_jk2 = 0.0;
+    const double* x = X + (long long) i * n_feat;
+    for (long long m = 0; m < n_feat; m++) {
+        double d_i = x[m] - X_pi[m];
+        double d_j = x[m] - X_pj[m];
+        d_ik2 += d_i * d_i;
+        d_jk2 += d_j * d_j;
+    }
+    const double* w = W + (long long) i * n_dim;
+    for (int k = 0; k < n_hyprpln; k++) {
+        double d_i = w[k] - W_pi[k];
+        double d_j = w[k] - W_pj[k];
+        d_ik2 -= d_i * d_i;
+        d_jk2 -= d_j * d_j;
+    }
+    if (d_ik2 < 0.0) d_ik2 = 0.0;
+    if (d_jk2 < 0.0) d_jk2 = 0.0;
+    out[i] = (d_ik2 + d_ij * d_ij - d_jk2) / (2.0 * d_ij + eps);
+}
+"""
+
+_project_kernel_cache = None
+
+
+def _project_kernel():
+    """
+    Return the compiled projection kernel, compiling it on first use.
+    """
+    global _project_kernel_cache
+    if _project_kernel_cache is None:
+        _project_kernel_cache = cp.RawKernel(
+            _PROJECT_KERNEL_SRC, "fastmap_project"
+        )
+
+    return (_project_kernel_cache)
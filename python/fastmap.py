@@ -0,0 +1,528 @@
+"""
+FastMapSVM: classify complex objects by embedding them in Euclidean
+space via the FastMap algorithm (Faloutsos & Lin, 1995) and training a
+Support Vector Machine on the embedded images.
+
+This module supersedes the prototype in jupyter/fastmap.ipynb.
+"""
+
+import h5py
+import marshal
+import numpy as np
+import pickle
+import scipy.fft
+import sklearn.svm
+import types
+import warnings
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+DTYPE_INT  = np.int32
+DTYPE_REAL = np.float64
+EPSILON    = 1e-9
+
+
+class FastMapSVM(object):
+
+    def __init__(self, distance, ndim, model_path, mode="a", numba=False):
+        """
+        Arguments
+        distance - Callable returning the distance between two objects.
+        ndim - Dimensionality of the Euclidean embedding.
+        model_path - Path to the HDF5 file backing the model.
+        numba - If True, compute Euclidean distance blocks with a
+            JIT-compiled, thread-parallel kernel. Requires numba and
+            the built-in euclidean metric.
+        """
+        if numba is True and globals()["numba"] is None:
+            raise (
+                ImportError(
+                    "numba acceleration requested but numba is not"
+                    " installed."
+                )
+            )
+        self._distance = distance
+        self._ndim = ndim
+        self._ihyprpln = 0
+        self._numba = numba
+        self._init_hdf5(model_path, mode)
+
+
+    @property
+    def clf(self):
+        if not hasattr(self, "_clf"):
+            stored = self.hdf5["clf"]
+            if isinstance(stored, h5py.Group):
+                self._clf = _load_clf(stored)
+            else:
+                # Legacy pickled classifier.
+                self._clf = pickle.loads(bytes(stored[()]))
+        return (self._clf)
+
+    @property
+    def hdf5(self):
+        return (self._hdf5)
+
+    @property
+    def ndim(self):
+        return (self._ndim)
+
+
+    def __del__(self):
+        # __init__ may raise before the HDF5 backend is initialized.
+        hdf5 = getattr(self, "_hdf5", None)
+        if hdf5 is not None:
+            hdf5.close()
+
+
+    def __enter__(self):
+        return (self)
+
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.hdf5.close()
+
+
+    def _distance_batch(self, X1, X2):
+        """
+        Return the (len(X1), len(X2)) matrix of base distances between
+        objects X1 and X2. Override this method to supply a custom
+        vectorized metric. The built-in correlation and Euclidean
+        metrics dispatch to batched kernels; arbitrary per-pair
+        callables fall back to a Python loop.
+        """
+        if self._distance is euclidean:
+            return (np.sqrt(_euclidean_block_squared(X1, X2)))
+        elif self._distance is distance:
+            return (_correlation_distance_block(X1, X2))
+
+        return (self._distance_batch_default(X1, X2))
+
+
+    def _distance_batch_default(self, X1, X2):
+        """
+        Compute the base distance block by looping a per-pair distance
+        callable. Deprecated slow path.
+        """
+        warnings.warn(
+            "Per-pair distance callables are deprecated; override"
+            " _distance_batch with a vectorized implementation.",
+            DeprecationWarning
+        )
+        dist = np.empty((len(X1), len(X2)), dtype=DTYPE_REAL)
+        for i in range(len(X1)):
+            for j in range(len(X2)):
+                dist[i, j] = self._distance(X1[i], X2[j])
+
+        return (dist)
+
+
+    def _choose_pivots(self, X, W):
+        """
+        Return a pair of indices corresponding to a heuristically
+        chosen pair of distal objects (Faloutsos & Lin, 1995).
+        """
+        n_obj = X.shape[0]
+        j_piv = np.random.choice(n_obj)
+        d = self.pdist(X, X[[j_piv]], W, W[[j_piv]])[:, 0]
+        i_piv = int(np.argmax(d))
+        d = self.pdist(X, X[[i_piv]], W, W[[i_piv]])[:, 0]
+        j_piv = int(np.argmax(d))
+
+        return (i_piv, j_piv)
+
+
+    def _init_hdf5(self, path, mode):
+        """
+        Initialize the HDF5 backend.
+        """
+        self._hdf5 = h5py.File(path, mode=mode)
+        # Serialize the metric only once per file; re-opening a model
+        # for interactive fit/predict cycles should not redo the
+        # marshal round-trip and attribute flush.
+        if "distance" not in self._hdf5.attrs:
+            self._hdf5.attrs["distance"] = np.void(
+                marshal.dumps(self._distance.__code__)
+            )
+            self._hdf5.attrs["ndim"] = self._ndim
+
+        return (True)
+
+
+    def embed(self, X):
+        """
+        Return the embedding, W, of objects, X, using the stored pivot
+        objects.
+        """
+        n_obj = X.shape[0]
+        X_piv = self.hdf5["X_piv"][:]
+        W_piv = self.hdf5["W_piv"][:]
+        d_piv = self.hdf5["d_piv"][:]
+        W = np.full((n_obj, self.ndim), np.nan, dtype=DTYPE_REAL)
+
+        for self._ihyprpln in range(self.ndim):
+            d_ij = d_piv[self._ihyprpln]
+            d_i = self.pdist(
+                X, X_piv[self._ihyprpln, [0]],
+                W, W_piv[self._ihyprpln, [0]]
+            )[:, 0]
+            d_j = self.pdist(
+                X, X_piv[self._ihyprpln, [1]],
+                W, W_piv[self._ihyprpln, [1]]
+            )[:, 0]
+            W[:, self._ihyprpln] = (
+                (d_i**2 + d_ij**2 - d_j**2) / (2 * d_ij + EPSILON)
+            )
+
+        return (W)
+
+
+    def fit(self, X, y):
+        """
+        Fit the model to labeled training objects, X, y. Embeds X via
+        FastMap, then trains an SVM on the images. Call save() to
+        persist the trained classifier.
+        """
+        W = self._embed_database(X)
+        self._clf = sklearn.svm.SVC(kernel="rbf", probability=True)
+        self._clf.fit(W, y)
+
+        return (self)
+
+
+    def _embed_database(self, X):
+        """
+        Embed the training objects, X, choosing and storing pivot
+        objects along the way.
+        """
+        n_obj = X.shape[0]
+        W = np.full((n_obj, self.ndim), np.nan, dtype=DTYPE_REAL)
+        X_piv = np.empty((self.ndim, 2, *X.shape[1:]), dtype=DTYPE_REAL)
+        d_piv = np.empty((self.ndim,), dtype=DTYPE_REAL)
+        pivot_ids = np.empty((self.ndim, 2), dtype=DTYPE_INT)
+
+        for self._ihyprpln in range(self.ndim):
+            i_piv, j_piv = self._choose_pivots(X, W)
+            pivot_ids[self._ihyprpln] = i_piv, j_piv
+            X_piv[self._ihyprpln, 0] = X[i_piv]
+            X_piv[self._ihyprpln, 1] = X[j_piv]
+            d_ij = self.pdist(
+                X[[i_piv]], X[[j_piv]], W[[i_piv]], W[[j_piv]]
+            )[0, 0]
+            d_piv[self._ihyprpln] = d_ij
+            if d_ij == 0:
+                W[:, self._ihyprpln] = 0
+                continue
+            d_i = self.pdist(X, X[[i_piv]], W, W[[i_piv]])[:, 0]
+            d_j = self.pdist(X, X[[j_piv]], W, W[[j_piv]])[:, 0]
+            W[:, self._ihyprpln] = (
+                (d_i**2 + d_ij**2 - d_j**2) / (2 * d_ij + EPSILON)
+            )
+
+        for key in ("W", "X_piv", "W_piv", "d_piv", "pivot_ids"):
+            if key in self.hdf5:
+                del (self.hdf5[key])
+        self.hdf5.create_dataset("W", data=W)
+        self.hdf5.create_dataset("X_piv", data=X_piv)
+        self.hdf5.create_dataset("W_piv", data=W[pivot_ids])
+        self.hdf5.create_dataset("d_piv", data=d_piv)
+        self.hdf5.create_dataset("pivot_ids", data=pivot_ids)
+
+        return (W)
+
+
+    def pdist(self, X1, X2, W1, W2):
+        """
+        Return the (len(X1), len(X2)) matrix of pairwise distances
+        between objects X1 and X2 projected onto hyperplane
+        self._ihyprpln. W1 and W2 are the (partial) images of X1 and
+        X2.
+        """
+        if self._numba is True and self._distance is euclidean:
+            X1 = np.ascontiguousarray(
+                np.asarray(X1, dtype=DTYPE_REAL).reshape(len(X1), -1)
+            )
+            X2 = np.ascontiguousarray(
+                np.asarray(X2, dtype=DTYPE_REAL).reshape(len(X2), -1)
+            )
+            W1 = np.ascontiguousarray(W1, dtype=DTYPE_REAL)
+            W2 = np.ascontiguousarray(W2, dtype=DTYPE_REAL)
+            dist = np.empty((len(X1), len(X2)), dtype=DTYPE_REAL)
+            _pdist_numba(X1, X2, W1, W2, self._ihyprpln, dist)
+
+            return (dist)
+
+        d2 = np.square(self._distance_batch(X1, X2))
+        for k in range(self._ihyprpln):
+            d2 -= np.square(W1[:, k, None] - W2[None, :, k])
+            np.clip(d2, 0, None, out=d2)
+
+        return (np.sqrt(d2))
+
+
+    def predict(self, X):
+        """
+        Return predicted labels for objects, X.
+        """
+        W = self.embed(X)
+
+        return (self.clf.predict(W))
+
+
+    def predict_proba(self, X):
+        """
+        Return predicted class probabilities for objects, X.
+        """
+        W = self.embed(X)
+
+        return (self.clf.predict_proba(W))
+
+
+    def save(self):
+        """
+        Persist the trained classifier to the HDF5 backend. The SVC
+        state is written as native, typed datasets rather than a
+        pickle blob.
+        """
+        if "clf" in self.hdf5:
+            del (self.hdf5["clf"])
+        clf = self._clf
+        group = self.hdf5.create_group("clf")
+        group.attrs["kernel"] = clf.kernel
+        group.attrs["degree"] = clf.degree
+        group.attrs["coef0"] = clf.coef0
+        group.attrs["gamma"] = clf._gamma
+        group.attrs["fit_status"] = clf.fit_status_
+        group.attrs["shape_fit"] = clf.shape_fit_
+        classes = np.asarray(clf.classes_)
+        if classes.dtype.kind == "U":
+            classes = classes.astype("S")
+        group.create_dataset("classes", data=classes)
+        group.create_dataset("support", data=clf.support_)
+        group.create_dataset(
+            "support_vectors", data=clf.support_vectors_
+        )
+        group.create_dataset("n_support", data=clf._n_support)
+        group.create_dataset("dual_coef", data=clf._dual_coef_)
+        group.create_dataset("intercept", data=clf._intercept_)
+        group.create_dataset("prob_a", data=clf._probA)
+        group.create_dataset("prob_b", data=clf._probB)
+
+        return (True)
+
+
+def _correlation_distance_block(X1, X2):
+    """
+    Return the (len(X1), len(X2)) matrix of correlation distances
+    between objects X1 and X2, computed for all pairs with one batched
+    FFT transform. Matches distance() applied per pair.
+    """
+    X1 = np.asarray(X1, dtype=DTYPE_REAL)
+    X2 = np.asarray(X2, dtype=DTYPE_REAL)
+    X1 = X1.reshape(len(X1), -1, X1.shape[-1])
+    X2 = X2.reshape(len(X2), -1, X2.shape[-1])
+    na, nb = X1.shape[-1], X2.shape[-1]
+    X1_std = X1.std(axis=-1, keepdims=True)
+    X2_std = X2.std(axis=-1, keepdims=True)
+    X1_std = np.where(X1_std == 0, 1, X1_std)
+    X2_std = np.where(X2_std == 0, 1, X2_std)
+    X1 = (X1 - X1.mean(axis=-1, keepdims=True)) / (X1_std * na)
+    X2 = (X2 - X2.mean(axis=-1, keepdims=True)) / X2_std
+    n_full = na + nb - 1
+    n_fft = scipy.fft.next_fast_len(n_full, real=True)
+    A = scipy.fft.rfft(X1, n=n_fft, axis=-1)
+    B = scipy.fft.rfft(X2[..., ::-1], n=n_fft, axis=-1)
+    c = scipy.fft.irfft(
+        A[:, None] * B[None, :], n=n_fft, axis=-1
+    )[..., :n_full]
+
+    return (1 - np.max(np.abs(c), axis=(-2, -1)))
+
+
+def _euclidean_block_squared(X1, X2):
+    """
+    Return the (len(X1), len(X2)) matrix of pairwise squared Euclidean
+    distances between X1 and X2, with trailing dimensions flattened.
+    """
+    X1 = np.asarray(X1, dtype=DTYPE_REAL).reshape(len(X1), -1)
+    X2 = np.asarray(X2, dtype=DTYPE_REAL).reshape(len(X2), -1)
+    S1 = np.square(X1).sum(axis=-1)
+    S2 = np.square(X2).sum(axis=-1)
+    d2 = S1[:, None] + S2[None, :] - 2 * (X1 @ X2.T)
+    np.clip(d2, 0, None, out=d2)
+
+    return (d2)
+
+
+if numba is not None:
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _pdist_numba(X1, X2, W1, W2, ihyprpln, out):
+        """
+        Fill out with the (len(X1), len(X2)) matrix of pairwise
+        Euclidean distances between X1 and X2 projected onto
+        hyperplane ihyprpln. X1 and X2 must be 2D with flattened
+        feature axes.
+        """
+        n1, n2 = X1.shape[0], X2.shape[0]
+        for i in numba.prange(n1):
+            for j in range(n2):
+                d2 = 0.0
+                for m in range(X1.shape[1]):
+                    diff = X1[i, m] - X2[j, m]
+                    d2 += diff * diff
+                for k in range(ihyprpln):
+                    diff = W1[i, k] - W2[j, k]
+                    d2 -= diff * diff
+                    if d2 < 0:
+                        d2 = 0.0
+                        break
+                out[i, j] = np.sqrt(d2)
+
+
+def _fft_correlate(a, b, mode="valid"):
+    """
+    Return the cross-correlation of a and b along the last axis via a
+    real-input FFT block transform. Leading axes are batched, and the
+    transform length is padded to a fast size so pocketfft reuses its
+    plan cache across calls.
+    """
+    na, nb = a.shape[-1], b.shape[-1]
+    n_full = na + nb - 1
+    n_fft = scipy.fft.next_fast_len(n_full, real=True)
+    A = scipy.fft.rfft(a, n=n_fft, axis=-1)
+    B = scipy.fft.rfft(b[..., ::-1], n=n_fft, axis=-1)
+    c = scipy.fft.irfft(A * B, n=n_fft, axis=-1)[..., :n_full]
+    if mode == "full":
+        return (c)
+    elif mode == "valid":
+        i_0 = min(na, nb) - 1
+        return (c[..., i_0: i_0 + max(na, nb) - min(na, nb) + 1])
+    elif mode == "same":
+        i_0 = (nb - 1) // 2
+        return (c[..., i_0: i_0 + na])
+    raise (ValueError(f"Unrecognized correlation mode: {mode}"))
+
+
+def correlate(a, b, mode="valid"):
+    """
+    Return the normalized cross-correlation of a and b.
+    """
+    a = (a - a.mean()) / (a.std() * len(a))
+    b = (b - b.mean()) / b.std()
+
+    return (_fft_correlate(a, b, mode=mode))
+
+
+def ndcorrelate(a, b, mode="valid"):
+    """
+    Return the normalized cross-correlation of the paired rows of
+    multi-channel data a and b. Trailing dimensions are the time axis;
+    leading dimensions are flattened to channel rows.
+
+    Equal-length rows — the common case of comparing waveforms on the
+    same time base — are correlated with a single batched FFT, with
+    zero-variance rows correlating to zero; unequal lengths fall back
+    to a per-row loop.
+    """
+    shape = a.shape[:-1]
+    a = a.reshape(-1, a.shape[-1])
+    b = b.reshape(-1, b.shape[-1])
+    n, na = a.shape
+    _, nb = b.shape
+    if na == nb:
+        a_std = a.std(axis=-1, keepdims=True)
+        b_std = b.std(axis=-1, keepdims=True)
+        a_std = np.where(a_std == 0, 1, a_std)
+        b_std = np.where(b_std == 0, 1, b_std)
+        a = (a - a.mean(axis=-1, keepdims=True)) / (a_std * na)
+        b = (b - b.mean(axis=-1, keepdims=True)) / b_std
+        c = _fft_correlate(a, b, mode=mode)
+
+        return (c.reshape(*shape, c.shape[-1]))
+
+    if mode == "full":
+        nc = na + nb - 1
+    elif mode == "valid":
+        nc = max(na, nb) - min(na, nb) + 1
+    else:
+        # "same" output matches the first input's length.
+        nc = na
+    c = np.empty((n, nc), dtype=DTYPE_REAL)
+    for i in range(n):
+        c[i] = correlate(a[i], b[i], mode=mode)
+
+    return (c.reshape(*shape, nc))
+
+
+def distance(a, b):
+    """
+    Return the correlation distance between objects a and b.
+    """
+    corr = ndcorrelate(a, b, mode="full")
+
+    return (1 - np.max(np.abs(corr)))
+
+
+def euclidean(a, b):
+    """
+    Return the Euclidean distance between objects a and b.
+    """
+    return (np.sqrt(np.sum(np.square(a - b))))
+
+
+def _load_clf(group):
+    """
+    Reconstruct an SVC from the native datasets written by
+    FastMapSVM.save().
+    """
+    clf = sklearn.svm.SVC(
+        kernel=group.attrs["kernel"],
+        degree=int(group.attrs["degree"]),
+        coef0=float(group.attrs["coef0"]),
+        probability=True
+    )
+    classes = group["classes"][:]
+    if classes.dtype.kind == "S":
+        classes = classes.astype("U")
+    clf.classes_ = classes
+    clf.support_ = group["support"][:]
+    clf.support_vectors_ = group["support_vectors"][:]
+    clf._n_support = group["n_support"][:]
+    clf._dual_coef_ = group["dual_coef"][:]
+    clf.dual_coef_ = clf._dual_coef_
+    clf._intercept_ = group["intercept"][:]
+    clf._probA = group["prob_a"][:]
+    clf._probB = group["prob_b"][:]
+    clf._gamma = float(group.attrs["gamma"])
+    clf._sparse = False
+    clf.fit_status_ = int(group.attrs["fit_status"])
+    clf.shape_fit_ = tuple(
+        int(n) for n in group.attrs["shape_fit"]
+    )
+    clf.n_features_in_ = clf.shape_fit_[1]
+
+    return (clf)
+
+
+def load(path, mode="a"):
+    """
+    Load a stored FastMapSVM model from path.
+    """
+    with h5py.File(path, mode="r") as f5:
+        code = marshal.loads(bytes(f5.attrs["distance"]))
+        ndim = int(f5.attrs["ndim"])
+    # Reuse the module-level metric when the stored code matches it, so
+    # that the identity checks dispatching to the batched (and numba)
+    # kernels keep working after a save/load round trip.
+    dist = globals().get(code.co_name)
+    if not (
+        isinstance(dist, types.FunctionType)
+        and dist.__code__.co_code == code.co_code
+    ):
+        dist = types.FunctionType(code, globals(), code.co_name)
+
+    return (FastMapSVM(dist, ndim, path, mode=mode))